@@ -38,6 +38,13 @@ options:
         description: Repo to install dists from.
         default: "git://github.com/LuaDist/Repository.git"
         type: str
+    assume_install_is_idempotent:
+        description:
+            - Install the packages directly instead of first checking which
+              ones are missing, relying on luadist to skip the installed ones.
+              Saves a luadist invocation on every run.
+        type: bool
+        default: false
 
 author:
     - Antonio Torres (@antoniotorresm)
@@ -72,7 +79,7 @@ cmd:
   description: luadist command used by the module
   returned: success
   type: str
-  sample: ./LuaDist/bin/luadist install -source=true -binary=true md5 lanes -repos="git://github.com/LuaDist/Repository.git"
+  sample: ./LuaDist/bin/luadist install md5 lanes -source=true -binary=true -repos=git://github.com/LuaDist/Repository.git
 name:
   description: List of Lua packages present in the environment
   returned: success
@@ -85,9 +92,34 @@ env_path:
   sample: /home/luauser/lua
 """
 
+import json
 import os
+import re
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves import shlex_quote
+
+# Matches "<name>-<version>" entries in the output of `luadist list`,
+# capturing both the full entry and the bare package name. Entries are
+# followed by a tab and the dist type, e.g.:
+#
+#   Installed packages:
+#   ==================
+#
+#     md5-1.2    (Linux-x86_64-binary)
+#     lua-cjson-2.1.0    (Linux-x86_64-binary)
+#
+# The version is the part after the last hyphen that is followed by a digit
+# or by scm/git, so hyphenated names (lua5-1-5.1) and hyphenated versions
+# (foo-2.0.0-beta) are both split correctly
+_LIST_RE = re.compile(r"^[ \t]*((\S+)-(?:\d|scm|git)\S*)", re.M)
+
+# Cache of packages known to be installed in the environment, relative to
+# the environment path. It is only trusted while the newest directory
+# modification time and the number of entries in the trees below (relative
+# to the LuaDist directory) are unchanged
+_INSTALLED_CACHE = os.path.join("LuaDist", ".ansible_installed.json")
+_INSTALLED_CACHE_DIRS = ("bin", "lib", "share")
 
 
 def run_module():
@@ -99,45 +131,81 @@ def run_module():
             type="str", default="all", choices=["all", "binary", "source"]
         ),
         dists_repo=dict(type="str", default="git://github.com/LuaDist/Repository.git"),
+        assume_install_is_idempotent=dict(type="bool", default=False),
     )
 
-    module = AnsibleModule(argument_spec=module_args)
+    module = AnsibleModule(argument_spec=module_args, supports_check_mode=True)
 
     path = module.params["path"]
-    packages = module.params["name"]
+    packages = module.params["name"] or []
     allow_dists = module.params["allow_dists"]
     dists_repo = module.params["dists_repo"]
+    assume_idempotent = module.params["assume_install_is_idempotent"]
 
     # define module result
     result = dict(changed=False, cmd="", env_path=path, name=packages)
 
+    luadist_present = _luadist_is_present(path)
+
+    # In check mode, guess whether there would be changes without running
+    # luadist. Packages are only known to be installed if they are cached
+    if module.check_mode:
+        installed = frozenset()
+        if luadist_present:
+            cache_key = _installed_cache_key(path)
+            installed = _load_installed_cache(path, cache_key) or frozenset()
+        result["changed"] = not (luadist_present and installed.issuperset(packages))
+        module.exit_json(**result)
+
     # Setup the Lua environment in the desired path
-    if not _luadist_is_present(path):
+    if not luadist_present:
         result["changed"] = True
         _setup_luadist(module, path)
 
-    # Ensure desired packages are installed
-    all_present = True
-    for package in packages:
-        if not _is_present(module, path, package):
-            all_present = False
-            break
-    if not all_present:
-        result["changed"] = True
-        result["cmd"] = _install_packages(
-            module, path, packages, allow_dists, dists_repo
-        )
+    # Ensure desired packages are installed. luadist is only queried if the
+    # cache does not already know about every package and installing them
+    # is not assumed to be idempotent
+    cache_key = _installed_cache_key(path)
+    installed = _load_installed_cache(path, cache_key) or frozenset()
+    cache_hit = installed.issuperset(packages)
+    if not cache_hit and not assume_idempotent:
+        uncached = [package for package in packages if package not in installed]
+        installed = installed.union(_installed_packages(module, path, uncached))
+    missing = [package for package in packages if package not in installed]
+    if missing:
+        cmd, changed = _install_packages(module, path, missing, allow_dists, dists_repo)
+        if changed:
+            result["changed"] = True
+            result["cmd"] = cmd
+        installed = installed.union(missing)
+        cache_key = _installed_cache_key(path)
+    if not cache_hit:
+        _save_installed_cache(path, cache_key, installed)
 
     module.exit_json(**result)
 
 
 def _luadist_is_present(path):
     """Returns whether luadist environment is in the specified path"""
-    return os.path.exists(os.path.join(path, "LuaDist/bin/luadist"))
+    return os.path.exists(os.path.join(path, "LuaDist", "bin", "luadist"))
 
 
 def _setup_luadist(module, path):
     """Creates luadist environment in the specified path"""
+    # The installer would create the environment inside an existing LuaDist
+    # directory. Only a stale cache of installed packages may be left there
+    luadist_dir = os.path.join(path, "LuaDist")
+    if os.path.isdir(luadist_dir):
+        _remove_installed_cache(path)
+        try:
+            os.rmdir(luadist_dir)
+        except OSError:
+            module.fail_json(
+                msg="Cannot create LuaDist environment, "
+                + luadist_dir
+                + " already exists and is not a LuaDist environment."
+            )
+
     cmd = "curl -fksSL https://tinyurl.com/luadist | bash"
     ret_code, out, err = module.run_command(cmd, cwd=path, use_unsafe_shell=True)
     if not _luadist_is_present(path):
@@ -149,28 +217,29 @@ def _setup_luadist(module, path):
         )
 
 
-def _is_present(module, path, pkgname):
-    """Returns whether package is installed"""
-    cmd = "./LuaDist/bin/luadist list " + pkgname
+def _installed_packages(module, path, packages):
+    """Returns the set of the given packages that are installed, using a
+    single luadist invocation"""
+    if not packages:
+        return frozenset()
+
+    cmd = ["./LuaDist/bin/luadist", "list"] + packages
     ret_code, out, err = module.run_command(cmd, cwd=path)
-    if ret_code != 0:
+    none_installed = "no packages matching" in out.lower()
+    if ret_code != 0 and not none_installed:
         module.fail_json(
             rc=ret_code,
             stdout=out,
             stderr=err,
             msg="Cannot check the status of one or more packages.",
         )
-    return pkgname in out
-
 
-def _install_packages(module, path, packages, allowed_dists, repo):
-    """Installs the specified packages. Returns the command used for installation"""
-    cmd = "./LuaDist/bin/luadist install "
+    return frozenset(name for entry in _LIST_RE.findall(out) for name in entry)
 
-    # Add packages to command
-    for package in packages:
-        cmd += package + " "
 
+def _install_packages(module, path, packages, allowed_dists, repo):
+    """Installs the specified packages. Returns the command used for installation
+    and whether any package was installed"""
     # Add types of dists allowed to command
     source_allowed = "true"
     binary_allowed = "true"
@@ -178,15 +247,16 @@ def _install_packages(module, path, packages, allowed_dists, repo):
         source_allowed = "false"
     elif allowed_dists == "source":
         binary_allowed = "false"
-    cmd += " -source=" + source_allowed + " -binary=" + binary_allowed
 
-    # Add repository to command
-    cmd += ' -repos="' + repo + '"'
+    argv = ["./LuaDist/bin/luadist", "install"] + packages
+    argv += ["-source=" + source_allowed, "-binary=" + binary_allowed]
+    argv += ["-repos=" + repo]
 
-    ret_code, out, err = module.run_command(cmd, cwd=path)
+    ret_code, out, err = module.run_command(argv, cwd=path)
     already_installed = "No packages to install" in out
 
     if ret_code != 0 and not already_installed:
+        _remove_installed_cache(path)
         module.fail_json(
             rc=ret_code,
             stdout=out,
@@ -195,7 +265,66 @@ def _install_packages(module, path, packages, allowed_dists, repo):
             + "make sure all packages exist in the configured repository.",
         )
 
-    return cmd
+    return " ".join(shlex_quote(arg) for arg in argv), not already_installed
+
+
+def _installed_cache_key(path):
+    """Returns the newest directory modification time and the number of
+    entries in the installation trees, or None if they cannot be determined.
+    Adding or removing a file updates the modification time of its parent
+    directory, so only directories need to be stat'ed"""
+    newest = None
+    entries = 0
+    for dirname in _INSTALLED_CACHE_DIRS:
+        top = os.path.join(path, "LuaDist", dirname)
+        if not os.path.isdir(top):
+            continue
+        for root, dirs, files in os.walk(top):
+            try:
+                mtime = os.stat(root).st_mtime
+            except OSError:
+                return None
+            if newest is None or mtime > newest:
+                newest = mtime
+            entries += len(dirs) + len(files)
+    if newest is None:
+        return None
+    return [newest, entries]
+
+
+def _load_installed_cache(path, key):
+    """Returns the cached set of installed packages, or None if there is no
+    cache or it does not match the given key"""
+    if key is None:
+        return None
+    try:
+        with open(os.path.join(path, _INSTALLED_CACHE)) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("mtime") != key:
+        return None
+    return frozenset(cache.get("installed", []))
+
+
+def _save_installed_cache(path, key, installed):
+    """Stores the set of installed packages. Failing to do so is not an error,
+    the packages will be queried again on the next run"""
+    if key is None:
+        return
+    try:
+        with open(os.path.join(path, _INSTALLED_CACHE), "w") as cache_file:
+            json.dump(dict(mtime=key, installed=sorted(installed)), cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def _remove_installed_cache(path):
+    """Removes the cache of installed packages, if any"""
+    try:
+        os.remove(os.path.join(path, _INSTALLED_CACHE))
+    except OSError:
+        pass
 
 
 def main():